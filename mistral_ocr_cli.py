@@ -2,10 +2,17 @@
 
 import os
 import sys
+import threading
 import argparse
+import asyncio
+import fnmatch
+import json
+import random
 from pathlib import Path
-import time
+import aiofiles
+import httpx
 from mistralai import Mistral
+from mistralai.models import SDKError
 import logging
 
 # Set up logging
@@ -16,6 +23,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Input PDFs and output markdown, relative to the working directory
+PDF_ROOT = Path('pdf')
+MD_ROOT = Path('markdown')
+
+# HTTP status codes worth retrying: rate limiting and temporary server errors
+_TRANSIENT_CODES = frozenset({429, 500, 502, 503, 504})
+
+# Records the (mtime_ns, size) of each processed PDF, keyed by its path relative to pdf/
+CACHE_FILENAME = '.ocr_cache.json'
+
+# Markdown directories already created during this run
+_created_dirs = set()
+
+# Precomputed page headers for typical page counts
+_PAGE_HEADERS = tuple(f"## Page {i}\n\n" for i in range(2048))
+
 def get_api_key():
     """Get Mistral API key from environment variable"""
     api_key = os.environ.get("MISTRAL_API_KEY")
@@ -24,220 +47,415 @@ def get_api_key():
         sys.exit(1)
     return api_key
 
-def get_markdown_filename(pdf_path):
+def get_markdown_filename(pdf_path, pdf_root=PDF_ROOT, md_root=MD_ROOT):
     """Generate corresponding markdown filename for a PDF"""
-    relative_path = pdf_path.relative_to(Path('pdf'))
-    markdown_path = Path('markdown').joinpath(relative_path)
-    
-    # Create parent directory if it doesn't exist
-    markdown_parent = markdown_path.parent
-    if not markdown_parent.exists():
-        markdown_parent.mkdir(parents=True, exist_ok=True)
-    
-    # Change extension to .md
-    return markdown_path.with_suffix('.md')
+    return (md_root / pdf_path.relative_to(pdf_root)).with_suffix('.md')
 
-def process_pdf(client, pdf_path, markdown_path, max_retries=3):
-    """Process PDF with Mistral OCR and save as markdown"""
-    logger.info(f"Processing {pdf_path}")
-    
-    # Retry loop for handling temporary server errors
-    retry_count = 0
-    while retry_count < max_retries:
+def ensure_dir(directory):
+    """Create a directory (and parents) once per run"""
+    # exist_ok makes directories from earlier runs cheap
+    if directory not in _created_dirs:
+        directory.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(directory)
+
+def iter_pdfs(pdf_dir, stop=None):
+    """Yield all PDFs under pdf_dir recursively, until the optional stop event is set"""
+    stack = [pdf_dir]
+    while stack and not (stop and stop.is_set()):
+        directory = stack.pop()
         try:
-            # Upload the PDF file
+            entries = os.scandir(directory)
+        except OSError:
+            # Skip missing or unreadable directories, like os.walk does
+            continue
+        with entries:
+            for entry in entries:
+                # DirEntry caches the file type, so this needs no extra stat
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith('.pdf'):
+                    yield Path(entry.path)
+
+def select_pdf_files(pdf_files, pdf_dir, patterns):
+    """Resolve --files patterns against the PDFs found under pdf_dir"""
+    pdfs_by_name = {str(pdf_path.relative_to(pdf_dir)): pdf_path for pdf_path in pdf_files}
+    resolved_pdf_dir = pdf_dir.resolve()
+    # A dict keeps the first-seen order and drops files matched by several patterns
+    selected = {}
+    unmatched = []
+    for file_pattern in patterns:
+        # Absolute paths must point inside pdf/ so they map to a markdown path
+        if Path(file_pattern).is_absolute():
             try:
-                with open(pdf_path, "rb") as f:
-                    file_content = f.read()
-                
-                uploaded_pdf = client.files.upload(
-                    file={
-                        "file_name": pdf_path.name,
-                        "content": file_content,
-                    },
-                    purpose="ocr"
-                )
-            except Exception as e:
-                error_message = str(e)
-                if "401" in error_message:
-                    logger.error("Authentication failed. Check your API key is correct and valid.")
-                    logger.error("Make sure to set the MISTRAL_API_KEY environment variable with a valid key.")
-                    return False
-                elif "502" in error_message or "Bad Gateway" in error_message:
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        wait_time = 5 * retry_count  # Progressive backoff: 5s, 10s, 15s
-                        logger.warning(f"Mistral API temporary error (502). Retrying in {wait_time}s... (Attempt {retry_count}/{max_retries})")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error(f"Mistral API unavailable after {max_retries} attempts. Please try again later.")
-                        return False
-                else:
-                    raise e
-            
-            # Get signed URL for the uploaded file
-            signed_url = client.files.get_signed_url(file_id=uploaded_pdf.id)
-            
-            # Process with OCR
-            ocr_response = client.ocr.process(
+                name = str(Path(file_pattern).resolve().relative_to(resolved_pdf_dir))
+            except ValueError:
+                name = None
+            if name in pdfs_by_name:
+                selected[pdfs_by_name[name]] = None
+            else:
+                unmatched.append(file_pattern)
+            continue
+        # './a.pdf' and 'sub//b.pdf' name the same files as 'a.pdf' and 'sub/b.pdf';
+        # a leading '..' stays and can never match a name under pdf/
+        pattern = os.path.normpath(file_pattern)
+        # Exact names first, so literal '[', ']' or '?' in a filename still match
+        if pattern in pdfs_by_name:
+            selected[pdfs_by_name[pattern]] = None
+            continue
+        matching_names = fnmatch.filter(pdfs_by_name, pattern)
+        if not matching_names:
+            unmatched.append(file_pattern)
+        for name in matching_names:
+            selected[pdfs_by_name[name]] = None
+    if unmatched:
+        logger.warning("No files found matching: %s", ", ".join(unmatched))
+    return list(selected)
+
+def find_existing_markdown(markdown_dir):
+    """Collect all existing markdown files in a single directory walk"""
+    return frozenset(
+        Path(root, name)
+        for root, _, files in os.walk(markdown_dir)
+        for name in files
+        if name.endswith('.md')
+    )
+
+def _classify(error):
+    """Classify an API error as 'auth', 'transient' or 'fatal'"""
+    # Connection failures and timeouts never reached the API
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return "transient"
+    # SDK errors carry the HTTP status of the failed response
+    status_code = getattr(error, "status_code", None)
+    if status_code == 401:
+        return "auth"
+    if status_code in _TRANSIENT_CODES:
+        return "transient"
+    return "fatal"
+
+def load_cache(cache_path):
+    """Load the processed-PDF cache, or an empty one if it is missing or unreadable"""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable cache %s: %s", cache_path, e)
+        return {}
+
+def save_cache(cache_path, cache):
+    """Write the processed-PDF cache atomically"""
+    tmp_path = cache_path.with_name(cache_path.name + '.tmp')
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, sort_keys=True)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+def get_pdf_signature(pdf_path):
+    """Cheap change detection key for a PDF: [mtime_ns, size]"""
+    stat = pdf_path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+def get_retry_delay(error, attempt, delay=3.0):
+    """Seconds to wait before retrying, with jittered exponential backoff"""
+    if isinstance(error, SDKError) and error.status_code == 429:
+        # Honor the server's Retry-After header if present
+        headers = getattr(error.raw_response, "headers", None) or {}
+        retry_after = headers.get("Retry-After")
+        try:
+            return min(60, max(0, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+    return min(60, delay * 2 ** (attempt - 1)) + random.random()
+
+async def _retry(coro_factory, max_retries=3, delay=3.0):
+    """Await coro_factory(), retrying rate limits and temporary server errors"""
+    attempt = 0
+    while True:
+        try:
+            return await coro_factory()
+        except Exception as e:
+            attempt += 1
+            if _classify(e) != "transient" or attempt >= max_retries:
+                raise
+            wait_time = get_retry_delay(e, attempt, delay)
+            logger.warning("Mistral API temporary error (%s). Retrying in %.1fs... (Attempt %d/%d)",
+                           getattr(e, 'status_code', type(e).__name__), wait_time, attempt, max_retries)
+            await asyncio.sleep(wait_time)
+
+async def upload_pdf(client, pdf_path):
+    """Upload a PDF to Mistral for OCR"""
+    # Pass the open file handle so httpx streams it in small
+    # chunks instead of holding the whole PDF in memory
+    with open(pdf_path, "rb") as f:
+        return await client.files.upload_async(
+            file={
+                "file_name": pdf_path.name,
+                "content": f,
+            },
+            purpose="ocr"
+        )
+
+async def process_pdf_async(client, pdf_path, markdown_path, max_retries=3, delay=3.0):
+    """Process PDF with Mistral OCR and save as markdown"""
+    logger.info("Processing %s", pdf_path)
+    
+    try:
+        # Upload the PDF file
+        uploaded_pdf = await _retry(lambda: upload_pdf(client, pdf_path), max_retries, delay)
+        
+        # Get signed URL for the uploaded file
+        signed_url = await _retry(
+            lambda: client.files.get_signed_url_async(file_id=uploaded_pdf.id),
+            max_retries, delay
+        )
+        
+        # Process with OCR. The endpoint takes exactly one document per request
+        # and the batch jobs API does not accept /v1/ocr (see
+        # mistral/plugin-redoc-0.yaml), so concurrency comes from the workers.
+        # The SDK already decodes the response with pydantic_core's Rust JSON
+        # parser, so there is no faster decoder to plug in here
+        ocr_response = await _retry(
+            lambda: client.ocr.process_async(
                 model="mistral-ocr-latest",
                 document={
                     "type": "document_url",
                     "document_url": signed_url.url,
                 }
-            )
-            
-            # Combine all pages into one markdown file
-            markdown_content = ""
-            for page in ocr_response.pages:
-                markdown_content += f"## Page {page.index}\n\n"
-                markdown_content += page.markdown + "\n\n"
-            
-            # Save to markdown file
-            with open(markdown_path, 'w', encoding='utf-8') as f:
-                f.write(markdown_content)
-            
-            logger.info(f"Saved markdown to {markdown_path}")
-            
-            # Add a small delay to avoid hitting rate limits
-            time.sleep(2)
-            
-            return True
-            
-        except Exception as e:
-            error_message = str(e)
-            if "401" in error_message:
-                logger.error("Authentication failed. Check your API key is correct and valid.")
-                logger.error("Make sure to set the MISTRAL_API_KEY environment variable with a valid key.")
-                return False
-            elif "502" in error_message or "Bad Gateway" in error_message or "timeout" in error_message.lower():
-                retry_count += 1
-                if retry_count < max_retries:
-                    wait_time = 5 * retry_count  # Progressive backoff: 5s, 10s, 15s
-                    logger.warning(f"Mistral API temporary error. Retrying in {wait_time}s... (Attempt {retry_count}/{max_retries})")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"Mistral API unavailable after {max_retries} attempts. Please try again later.")
-                    return False
+            ),
+            max_retries, delay
+        )
+        
+        # Write pages straight to a temp file rather than building the whole
+        # document in memory, then move it into place so an interrupted write
+        # never leaves a truncated markdown file that looks processed
+        ensure_dir(markdown_path.parent)
+        tmp_path = markdown_path.with_name(markdown_path.name + '.tmp')
+        try:
+            async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                for page in ocr_response.pages:
+                    index = page.index
+                    header = _PAGE_HEADERS[index] if 0 <= index < len(_PAGE_HEADERS) else f"## Page {index}\n\n"
+                    await f.write(f"{header}{page.markdown}\n\n")
+            os.replace(tmp_path, markdown_path)
+        except BaseException:
+            # Also on cancellation, so no stray .md.tmp is left in markdown/
+            tmp_path.unlink(missing_ok=True)
+            raise
+        
+        logger.info("Saved markdown to %s", markdown_path)
+        
+        return True
+        
+    except Exception as e:
+        error_kind = _classify(e)
+        if error_kind == "auth":
+            # Every other request would fail the same way; let the worker stop the run
+            raise
+        elif error_kind == "transient":
+            logger.error("Mistral API unavailable after %d attempts. Please try again later.", max_retries)
+        else:
+            logger.error("Error processing %s: %s", pdf_path, e)
+        return False
+
+async def worker(client, queue, results, auth_failed, max_retries=3, delay=3.0):
+    """Process queued (pdf_path, markdown_path) jobs until a None sentinel arrives"""
+    while True:
+        job = await queue.get()
+        try:
+            if job is None:
+                return
+            pdf_path, markdown_path = job
+            if auth_failed.is_set():
+                # Drain the queue without calling the API
+                result = False
             else:
-                logger.error(f"Error processing {pdf_path}: {error_message}")
-                return False
-    
-    # If we get here, we exhausted all retries
-    return False
+                try:
+                    result = await process_pdf_async(client, pdf_path, markdown_path, max_retries=max_retries, delay=delay)
+                except Exception:
+                    # process_pdf_async handles everything except auth errors
+                    result = False
+                    if not auth_failed.is_set():
+                        auth_failed.set()
+                        logger.error("Authentication failed. Check your API key is correct and valid.")
+                        logger.error("Make sure to set the MISTRAL_API_KEY environment variable with a valid key.")
+            results.append((pdf_path, result))
+        finally:
+            queue.task_done()
+
+async def process_all(client, jobs, concurrency, max_retries=3, delay=3.0):
+    """Process (pdf_path, markdown_path) jobs with `concurrency` worker tasks
+
+    Returns the (pdf_path, result) pairs and whether the API key was rejected.
+    """
+    # A bounded queue keeps at most `concurrency` requests in flight and
+    # feeds new PDFs to the workers only as they free up
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    results = []
+    # Set by the first 401 so the remaining PDFs are skipped instead of uploaded
+    auth_failed = asyncio.Event()
+    workers = [
+        asyncio.create_task(worker(client, queue, results, auth_failed, max_retries=max_retries, delay=delay))
+        for _ in range(concurrency)
+    ]
+    for job in jobs:
+        await queue.put(job)
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    return results, auth_failed.is_set()
 
-def check_api_connection(client):
+def create_http_client(concurrency):
+    """Create one pooled HTTP/2 client shared by all concurrent API calls"""
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    # Retries are handled by _retry, not the transport
+    transport = httpx.AsyncHTTPTransport(http2=True, retries=0, limits=limits)
+    return httpx.AsyncClient(transport=transport, follow_redirects=True)
+
+async def check_api_connection(client):
     """Check if we can connect to the Mistral API with the provided key"""
     try:
         # Make a simple API call to test connection and authentication
         # Just getting models is a lightweight operation
-        client.models.list()
+        await client.models.list_async()
         return True
     except Exception as e:
-        error_message = str(e)
-        if "401" in error_message:
+        error_kind = _classify(e)
+        if error_kind == "auth":
             logger.error("API key authentication failed. Please check your MISTRAL_API_KEY.")
             logger.error("You can get an API key from https://console.mistral.ai/")
-        elif "502" in error_message or "Bad Gateway" in error_message:
-            logger.error("Mistral API service is temporarily unavailable (502 Bad Gateway).")
+        elif error_kind == "transient":
+            logger.error("Mistral API service is temporarily unavailable (%s).", getattr(e, 'status_code', e))
             logger.error("Please wait a few minutes and try again.")
         else:
-            logger.error(f"API connection error: {error_message}")
+            logger.error("API connection error: %s", e)
         return False
 
+async def find_pdf_files(client, pdf_dir, check_api=False):
+    """Walk pdf_dir for PDFs while the optional API check runs; None if the check fails"""
+    stop_walk = threading.Event()
+    walk = asyncio.create_task(asyncio.to_thread(list, iter_pdfs(pdf_dir, stop_walk)))
+    if check_api:
+        logger.info("Testing API connection...")
+        if not await check_api_connection(client):
+            # Abandon the walk; there is nothing to process without a working key
+            stop_walk.set()
+            await walk
+            return None
+        logger.info("API connection successful!")
+    return await walk
+
+async def run(client, args):
+    """Find PDFs, skip up-to-date ones and process the rest; False if the API key was rejected"""
+    try:
+        markdown_dir = MD_ROOT
+        pdf_dir = PDF_ROOT
+        
+        # Find all PDFs recursively, then narrow down to --files if given
+        pdf_files = await find_pdf_files(client, pdf_dir, check_api=args.check_api)
+        if pdf_files is None:
+            logger.error("API connection failed. Exiting.")
+            return False
+        if args.files:
+            pdf_files = select_pdf_files(pdf_files, pdf_dir, args.files)
+        
+        if not pdf_files:
+            logger.info("No PDF files found to process")
+            return True
+        
+        logger.info("Found %d PDF files", len(pdf_files))
+        
+        # Decide which PDFs need processing; skips are counted before any task starts
+        skipped_count = 0
+        unreadable_count = 0
+        jobs = []
+        signatures = {}
+        
+        # One walk of markdown/ instead of an exists() check per PDF
+        existing_markdown = frozenset() if args.force else find_existing_markdown(markdown_dir)
+        cache_path = markdown_dir / CACHE_FILENAME
+        cache = load_cache(cache_path)
+        
+        for pdf_path in pdf_files:
+            markdown_path = get_markdown_filename(pdf_path, pdf_dir, markdown_dir)
+            cache_key = str(pdf_path.relative_to(pdf_dir))
+            try:
+                signature = get_pdf_signature(pdf_path)
+            except OSError as e:
+                # A dangling symlink or a file removed since the walk fails on its own
+                logger.error("Cannot read %s: %s", pdf_path, e)
+                unreadable_count += 1
+                continue
+            
+            # Skip if markdown file already exists for an unchanged PDF and not forcing
+            if markdown_path in existing_markdown:
+                # Markdown converted before the cache existed is taken as up to date
+                cached_signature = cache.setdefault(cache_key, signature)
+                if cached_signature == signature:
+                    logger.info("Skipping %s (already processed)", pdf_path)
+                    skipped_count += 1
+                    continue
+                logger.info("%s changed since it was last processed", pdf_path)
+            
+            signatures[pdf_path] = (cache_key, signature)
+            
+            if args.dry_run:
+                logger.info("Would process: %s -> %s", pdf_path, markdown_path)
+            
+            jobs.append((pdf_path, markdown_path))
+        
+        auth_failed = False
+        if args.dry_run:
+            processed_count, failed_count = len(jobs), unreadable_count
+        else:
+            # Process the remaining PDFs concurrently and tally once at the end
+            results = []
+            if jobs:
+                results, auth_failed = await process_all(client, jobs, args.concurrency, max_retries=args.max_retries, delay=args.delay)
+            processed_count = sum(result is True for _, result in results)
+            failed_count = len(results) - processed_count + unreadable_count
+            
+            # Remember what was processed so unchanged PDFs are skipped next time
+            for pdf_path, result in results:
+                if result is True:
+                    cache_key, signature = signatures[pdf_path]
+                    cache[cache_key] = signature
+            save_cache(cache_path, cache)
+        
+        logger.info("Processing complete. Processed: %d, Skipped: %d, Failed: %d", processed_count, skipped_count, failed_count)
+        # An invalid key must still fail the run, even without --check-api
+        return not auth_failed
+    finally:
+        # The SDK leaves a caller-supplied HTTP client open
+        await client.sdk_configuration.async_client.aclose()
+
 def main():
     parser = argparse.ArgumentParser(description="Convert PDFs to markdown using Mistral OCR")
     parser.add_argument("--dry-run", action="store_true", help="Only show what would be processed without actually processing")
     parser.add_argument("--files", nargs="+", help="Specific PDF files to process (relative to the pdf/ directory)")
     parser.add_argument("--force", action="store_true", help="Process files even if markdown already exists")
     parser.add_argument("--max-retries", type=int, default=3, help="Maximum number of retries for API errors")
-    parser.add_argument("--delay", type=float, default=3.0, help="Delay in seconds between processing files (default: 3.0)")
+    parser.add_argument("--delay", type=float, default=3.0, help="Base delay in seconds for exponential retry backoff (default: 3.0)")
+    parser.add_argument("--check-api", action="store_true", help="Test the API key with a lightweight request before processing")
+    parser.add_argument("--concurrency", type=int, default=os.environ.get("OCR_CONCURRENCY", 4),
+                        help="Maximum number of PDFs processed concurrently (default: $OCR_CONCURRENCY or 4)")
     args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
     
     # Get API key and initialize client
     api_key = get_api_key()
-    client = Mistral(api_key=api_key)
-    
-    # Check API connection if not in dry-run mode
-    if not args.dry_run:
-        logger.info("Testing API connection...")
-        if not check_api_connection(client):
-            logger.error("API connection failed. Exiting.")
-            sys.exit(1)
-        logger.info("API connection successful!")
-    
-    # Create markdown directory if it doesn't exist
-    markdown_dir = Path('markdown')
-    if not markdown_dir.exists():
-        markdown_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Find PDF files
-    pdf_dir = Path('pdf')
-    
-    if args.files:
-        # Process specific files
-        pdf_files = []
-        for file_pattern in args.files:
-            # Handle both absolute paths and paths relative to pdf/
-            if Path(file_pattern).is_absolute():
-                if Path(file_pattern).exists():
-                    pdf_files.append(Path(file_pattern))
-                else:
-                    logger.warning(f"File not found: {file_pattern}")
-            else:
-                # Treat as relative to pdf/
-                relative_path = pdf_dir / file_pattern
-                if relative_path.exists():
-                    pdf_files.append(relative_path)
-                else:
-                    # Try with wildcards
-                    matching_files = list(pdf_dir.glob(file_pattern))
-                    if matching_files:
-                        pdf_files.extend(matching_files)
-                    else:
-                        logger.warning(f"No files found matching: {file_pattern}")
-    else:
-        # Find all PDFs recursively
-        pdf_files = list(pdf_dir.glob('**/*.pdf'))
+    client = Mistral(api_key=api_key, async_client=create_http_client(args.concurrency))
     
-    if not pdf_files:
-        logger.info("No PDF files found to process")
-        return
+    # Create markdown directory first so permission errors surface before any API call
+    ensure_dir(MD_ROOT)
     
-    logger.info(f"Found {len(pdf_files)} PDF files")
-    
-    # Process each PDF
-    processed_count = 0
-    skipped_count = 0
-    failed_count = 0
-    
-    for i, pdf_path in enumerate(pdf_files):
-        markdown_path = get_markdown_filename(pdf_path)
-        
-        # Skip if markdown file already exists and not forcing
-        if markdown_path.exists() and not args.force:
-            logger.info(f"Skipping {pdf_path} (already processed)")
-            skipped_count += 1
-            continue
-        
-        if args.dry_run:
-            logger.info(f"Would process: {pdf_path} -> {markdown_path}")
-            processed_count += 1
-            continue
-        
-        # Add delay between files (but not before the first one)
-        if i > 0:
-            logger.info(f"Waiting {args.delay} seconds before processing next file...")
-            time.sleep(args.delay)
-        
-        success = process_pdf(client, pdf_path, markdown_path, max_retries=args.max_retries)
-        if success:
-            processed_count += 1
-        else:
-            failed_count += 1
-    
-    logger.info(f"Processing complete. Processed: {processed_count}, Skipped: {skipped_count}, Failed: {failed_count}")
+    if not asyncio.run(run(client, args)):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file